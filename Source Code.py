@@ -4,6 +4,23 @@ remaining value and degree heuristics could not choose one.
 """
 import random
 
+"""
+The deque from the collections module is used as the queue of arcs in AC-3.
+"""
+from collections import deque
+
+"""
+The multiprocessing module is used to search the subtrees under the values of
+the first variable in parallel.
+"""
+import multiprocessing
+
+"""
+The queue module is only used for the Empty exception that the queue of results raises
+when nothing comes back before the timeout.
+"""
+import queue
+
 """
 The class below sets up a constraint-satisfaction problem using the
 info found in the input file.
@@ -11,18 +28,35 @@ info found in the input file.
 class CSP():
     """
     The class is initialized using the variables, domain_values, and
-    neighbors_dictionary read in from the input file. If forward-checking
-    is set to true, the current_domains & pruned dictionaries are also set.
+    neighbors_dictionary read in from the input file. The domain values are the
+    indices of the colors, so every comparison is between small integers. Each
+    variable's domain is also stored as a bitmask in domain_mask, where bit i is
+    set if the i-th domain value is available. If forward-checking is set to true,
+    the current_domains list is also set, holding the domain of variable i at index i.
+    Every value pruned by forward-checking is pushed onto the trail as a (neighbor,
+    bit) pair, and trail_marks holds the length of the trail at every assignment so
+    it can be undone on back-tracking. The assigned_neighbor_count dictionary keeps
+    how many neighbors of each variable are currently assigned. The variables are
+    integer indices, and bit i of assigned_mask is set while variable i is assigned.
+    The degree list holds the number of neighbors of each variable. If nogood
+    recording is enabled, the nogoods set holds the keys of partial assignments that
+    are known to have no solution.
     """
     def __init__(self, variables, domain_values, neighbors_dictionary):
         self.current_domains = None
-        self.conflicts = None
+        self.trail = []
+        self.trail_marks = []
         self.number_assigned = 0
         self.variables = variables
         self.domain_values = domain_values
+        self.domain_mask = {v: (1 << len(domain_values[v])) - 1 for v in variables}
         self.neighbors_dictionary = neighbors_dictionary
+        self.degree = [len(neighbors_dictionary[v]) for v in variables]
         self.is_forward_checking = False
-        self.assigned_variables = {}
+        self.assignment = [-1 for v in variables]
+        self.assigned_mask = 0
+        self.assigned_neighbor_count = {v: 0 for v in variables}
+        self.nogoods = None
     
     """
     The function below checks if two domain values are equal meaning
@@ -32,163 +66,352 @@ class CSP():
         return value1 == value2
 
     """
-    The function below assigns a variable with the passed in domain value and
-    adds it to the assigned_variables dictionary. If forward-checking is set to
-    true, the forward_checking function will change all the passed in variable's
-    neighbors' domains.
+    The function below assigns a variable with the passed in domain value index
+    by storing it at the variable's index in the assignment list. If forward-checking
+    is set to true, the forward_checking function will change all the passed in
+    variable's neighbors' domains. It returns False if that leaves a neighbor with no
+    values, and True otherwise. Either way the variable stays assigned until
+    unassign_variable is called.
     """
     def assign_variable(self, variable, value):
-        self.assigned_variables[variable] = value
+        self.assignment[variable] = value
+        self.assigned_mask |= 1 << variable
         self.number_assigned += 1
+        self.trail_marks.append(len(self.trail))
+        assigned_neighbor_count = self.assigned_neighbor_count
+        for neighbor in self.neighbors_dictionary[variable]:
+            assigned_neighbor_count[neighbor] += 1
         
         if self.current_domains and self.is_forward_checking:
-            self.forward_checking(variable, value)
+            return self.forward_checking(variable, value)
+        return True
+
+    """
+    The function below unassigns the passed in variable by setting its entry in the
+    assignment list back to -1. It pops every (neighbor, bit) pair pushed onto the
+    trail since the variable was assigned and puts the bit back into the neighbor's
+    domain.
+    """
+    def unassign_variable(self, variable):
+        self.assignment[variable] = -1
+        self.assigned_mask &= ~(1 << variable)
+        self.number_assigned -= 1
+        mark = self.trail_marks.pop()
+        assigned_neighbor_count = self.assigned_neighbor_count
+        for neighbor in self.neighbors_dictionary[variable]:
+            assigned_neighbor_count[neighbor] -= 1
+
+        trail = self.trail
+        current_domains = self.current_domains
+        while len(trail) > mark:
+            (neighbor, bit) = trail.pop()
+            current_domains[neighbor] |= bit
 
     """
     The function below does all the necessary modifications to the neighbors'
-    domains of the passed in variable.
+    domains of the passed in variable. The domains are bitmasks, so the passed in
+    value index is turned into a single bit that is cleared from every neighbor.
+    It returns False as soon as a neighbor's domain becomes empty, since the
+    assignment cannot lead to a solution, and True otherwise.
     """
     def forward_checking(self, variable, value):
         if self.current_domains:
             """
-            Restore conflicted values with neighbors, if any, to perform forward-checking
-            correctly. It will only go inside this for loop if the algorithm back-tracked.
-            """
-            for (neighbor, val) in self.conflicts[variable]:
-                self.current_domains[neighbor].append(val)
-            self.conflicts[variable] = []
-            """
-            The section below performs the forward-checking itself. It loops through every
-            neighbor of the passed-in variable and checks to see if the values in its domain
-            conflict with the value assigned. If so, it will add the neighbor and the
-            conflicting value to the list of conflicts for that variable. It will also remove
-            the conflicting value from the neighbor's domain.
+            It loops through every unassigned neighbor of the passed-in variable and clears
+            the bit of the assigned value from its domain. If the bit was set, the neighbor
+            and the removed bit are pushed onto the trail. The attributes used in the loop
+            are bound to local names first so every neighbor costs no attribute lookups.
             """
+            bit = 1 << value
+            current_domains = self.current_domains
+            assigned_mask = self.assigned_mask
+            push = self.trail.append
             for neighbor in self.neighbors_dictionary[variable]:
-                if neighbor not in self.assigned_variables:
-                    for val in self.current_domains[neighbor][:]:
-                        if self.are_values_constrained(value, val):
-                            self.conflicts[variable].append((neighbor, val))
-                            self.current_domains[neighbor].remove(val)
+                if not assigned_mask >> neighbor & 1:
+                    removed = current_domains[neighbor] & bit
+                    if removed:
+                        current_domains[neighbor] ^= removed
+                        push((neighbor, removed))
+                        if not current_domains[neighbor]:
+                            return False
+        return True
+
+    """
+    The function below returns a key for the current partial assignment to be stored
+    in the nogoods set. What is left to solve only depends on which variables are
+    unassigned and on the values of the assigned variables next to them, since those
+    are the only ones that can still conflict with a future assignment. So the key is
+    the assigned_mask together with the values of the assigned variables that have at
+    least one unassigned neighbor. Two partial assignments with the same key either
+    both have a solution or both do not.
+    """
+    def nogood_key(self):
+        boundary = frozenset((v, value) for (v, value) in enumerate(self.assignment)
+                             if value >= 0 and
+                             self.assigned_neighbor_count[v] < self.degree[v])
+        return (self.assigned_mask, boundary)
 
     """
     The function below calculates the number of conflicts the passed in value
-    will have with all the passed in variable's neighbors and returns it.
+    will have with all the passed in variable's neighbors and returns it. Unassigned
+    neighbors hold -1 in the assignment list, which never matches a domain value index.
     """
     def number_of_conflicts(self, variable, value):
-        neighbor_value = ""
         count = 0
         for neighbor in self.neighbors_dictionary[variable]:
-            if neighbor in self.assigned_variables:
-                neighbor_value = self.assigned_variables[neighbor]
-            if self.are_values_constrained(value, neighbor_value):
+            if self.are_values_constrained(value, self.assignment[neighbor]):
                 count += 1
         return count
 
 """
-The function below is a wrapper for the recursive algorithm itself. It also
+The function below is a wrapper for the backtracking algorithm itself. It also
 takes in a boolean specifying whether forward-checking is set to true or not.
-If forward-checking is set to true, the current_domains and pruned dictionaries
-are set. 
+If forward-checking is set to true, the current_domains list is set and AC-3 is
+run on it once before the search starts. Since the variables are the indices
+0 to n - 1, the domains are kept in one flat list instead of a dictionary. The
+result is the assignment list, holding the index of the color of variable i at
+index i. If number_of_processes is more than one, the search is split between
+that many processes by parallel_backtracking. If is_recording_nogoods is set to
+true, the nogoods set is created so failed partial assignments are remembered.
+This is off by default: with forward-checking the same partial assignment is
+practically never reached twice, so the keys only cost time and memory.
 """
-def backtracking_algorithm(csp, is_forward_checking = False):
+def backtracking_algorithm(csp, is_forward_checking = False, number_of_processes = 1,
+                           is_recording_nogoods = False):
+    if is_recording_nogoods:
+        csp.nogoods = set()
     if is_forward_checking:
-        csp.current_domains, csp.pruned = {}, {}
-        for v in csp.variables:
-            csp.current_domains[v] = csp.domain_values[v][:]
-            csp.pruned[v] = []
+        csp.current_domains = [csp.domain_mask[v] for v in csp.variables]
         csp.is_forward_checking = True
-    csp = csp
-    return recursive_backtracking(csp)
+        if not ac3(csp):
+            return None
+    if number_of_processes > 1:
+        return parallel_backtracking(csp, number_of_processes)
+    return iterative_backtracking(csp)
+
+"""
+The function below makes the current domains arc-consistent using AC-3. Every arc
+(xi, xj) starts in the queue. Since neighbors must have different values, the arc
+can only be revised when xj has a single value left, in which case that value is
+removed from the domain of xi. If the domain of xi changed, every arc pointing to
+xi is put back into the queue. It returns False if any domain becomes empty.
+"""
+def ac3(csp):
+    arcs = deque((xi, xj) for xi in csp.variables for xj in csp.neighbors_dictionary[xi])
+    while arcs:
+        (xi, xj) = arcs.popleft()
+        domain = csp.current_domains[xj]
+        if domain.bit_count() == 1 and csp.current_domains[xi] & domain:
+            csp.current_domains[xi] &= ~domain
+            if csp.current_domains[xi] == 0:
+                return False
+            for xk in csp.neighbors_dictionary[xi]:
+                if xk != xj:
+                    arcs.append((xk, xi))
+    return True
 
 """
-The function below is the recursive algorithm itself. It first checks to see if
-all the variables have been assigned or not. If not, the algorithm will first pick
-an unassigned variable. Then, it will check every domain value to see the number of
-conflicts each has. It will only assign a variable to a specific value if the number
-of conflicts it has is zero.
+The function below is the backtracking algorithm itself. Instead of recursing, it keeps
+an explicit stack with one frame per assigned variable, holding the variable and an
+iterator over its values, from order_domain_values if forward-checking is set to true
+and from consistent_domain_values otherwise. Each step unassigns the top frame's
+variable if needed and assigns its next value, which is given up right away if it
+empties a neighbor's domain. A frame that runs out of values is popped. If nogood
+recording is enabled, each frame also keeps the key of its partial assignment, which is
+added to the nogoods set when the frame is popped, and no frame is pushed for a key
+already in it.
 """
-def recursive_backtracking(csp):
-    if len(csp.assigned_variables) == len(csp.variables):
-        return csp.assigned_variables
+def iterative_backtracking(csp):
+    if csp.number_assigned == len(csp.variables):
+        return csp.assignment
+
+    if csp.is_forward_checking:
+        ordered_values = order_domain_values
+    else:
+        ordered_values = consistent_domain_values
 
     variable = select_unassigned_variable(csp)
-    for value in order_domain_values(variable, csp):
-        if csp.number_of_conflicts(variable, value) == 0:
-            csp.assign_variable(variable, value)
-            result = recursive_backtracking(csp)
-            if result is not None:
-                return result
+    is_recording_nogoods = csp.nogoods is not None
+    key = csp.nogood_key() if is_recording_nogoods else None
+    stack = [(variable, iter(ordered_values(variable, csp)), key)]
+    while stack:
+        (variable, values, key) = stack[-1]
+        if csp.assigned_mask >> variable & 1:
+            csp.unassign_variable(variable)
+
+        value = next(values, None)
+        if value is None:
+            if is_recording_nogoods:
+                csp.nogoods.add(key)
+            stack.pop()
+            continue
+        if not csp.assign_variable(variable, value):
+            continue
+
+        if csp.number_assigned == len(csp.variables):
+            return csp.assignment
+        if is_recording_nogoods:
+            key = csp.nogood_key()
+            if key in csp.nogoods:
+                continue
+        variable = select_unassigned_variable(csp)
+        stack.append((variable, iter(ordered_values(variable, csp)), key))
     return None
 
+"""
+The function below splits the search at its root. It picks the first variable the same
+way the backtracking algorithm does and puts every value it can take into a queue of
+tasks. Each worker process runs search_subtrees, taking the next value from the queue
+as soon as it is done with the previous one, and puts the result of every subtree into
+a queue of results. Every worker has its own copy of the CSP object, so they do not
+share anything. The first solution that comes back is returned, and the workers still
+searching are then terminated. If a worker raises an exception, it is put into the
+queue of results and raised again here. The queue is also polled with a timeout, so a
+worker that dies without getting to put anything, such as one killed by the operating
+system, is noticed through its exit code. If every worker has exited and results are
+still missing, for example because an exception could not be pickled and was dropped,
+an error is raised as well instead of leaving this function waiting. The workers are
+checked before each wait, so results put just before a worker exited are still read.
+"""
+def parallel_backtracking(csp, number_of_processes):
+    if csp.number_assigned == len(csp.variables):
+        return csp.assignment
+
+    variable = select_unassigned_variable(csp)
+    if csp.is_forward_checking:
+        values = order_domain_values(variable, csp)
+    else:
+        values = consistent_domain_values(variable, csp)
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=search_subtrees,
+                                       args=(csp, variable, tasks, results))
+               for _ in range(min(number_of_processes, len(values)))]
+    for value in values:
+        tasks.put(value)
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+
+    result = None
+    try:
+        remaining = len(values)
+        while remaining:
+            is_any_worker_alive = any(worker.is_alive() for worker in workers)
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                for worker in workers:
+                    if worker.exitcode:
+                        raise RuntimeError("worker process exited with code "
+                                           + str(worker.exitcode))
+                if not is_any_worker_alive:
+                    raise RuntimeError("worker processes exited with "
+                                       + str(remaining) + " results missing")
+                continue
+            if isinstance(result, Exception):
+                raise result
+            if result is not None:
+                break
+            remaining -= 1
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+    return result
+
+"""
+The function below runs in a worker process. For every value it takes from the queue of
+tasks, it assigns the passed in variable to that value, searches the rest of the problem
+with the backtracking algorithm, and puts the result into the queue of results. It stops
+when it finds a solution or takes None from the queue. If the search raises an
+exception, the exception is put into the queue of results instead so that
+parallel_backtracking can raise it again.
+"""
+def search_subtrees(csp, variable, tasks, results):
+    try:
+        value = tasks.get()
+        while value is not None:
+            if csp.assign_variable(variable, value):
+                result = iterative_backtracking(csp)
+            else:
+                result = None
+            results.put(result)
+            if result is not None:
+                return
+            csp.unassign_variable(variable)
+            value = tasks.get()
+    except Exception as error:
+        results.put(error)
+
 """
 The function below selects an unassigned variable using the minimum-remaining-value
 and degree heuristics.
 """
 def select_unassigned_variable(csp):
     """
-    This section below in the function is for the minimum-remaining-value heuristic.
-    It checks to see the number of assigned neighbors each variable has. It then
-    chooses the one with the most assigned neighbors, which corresponds to the
-    variable with the least remaining values. 
-    """
-    minimum_remaining_values_list = []
-    current_max = 0
-    temp_max = 0
-    for variable in csp.variables:
-        if variable not in csp.assigned_variables:
-            for neighbor in csp.neighbors_dictionary[variable]:
-                if neighbor in csp.assigned_variables:
-                    temp_max += 1
-                if temp_max == current_max:
-                    if len(minimum_remaining_values_list) > 0:
-                        if minimum_remaining_values_list[-1] != variable:
-                            minimum_remaining_values_list.append(variable)
-                    else:
-                        minimum_remaining_values_list.append(variable)
-                elif temp_max > current_max:
-                    minimum_remaining_values_list = [variable]
-                    current_max = temp_max
-                temp_max = 0
-    """
-    This section below works on the list of variables with the least remaining domain
-    values from the previous section. It first checks if there is only one variable
-    in the list, in that case it just returns it. If there is more than one variable
-    in the list, the degree heuristic is applied. It creates a list of variables with
-    the most neighbors. If there is only variable in the list, it is returned. If there
-    is more than one variable, meaning both the minimum remaining value and the degree
-    heuristics could not choose a variable, a random variable is chosen and returned.
-    """
-    if len(minimum_remaining_values_list) == 1:
-        return minimum_remaining_values_list.pop()
+    The minimum-remaining-value heuristic uses the number of bits left in a variable's
+    current domain. If forward-checking is not set to true, the variable with the most
+    assigned neighbors is treated as the one with the least remaining values. Ties are
+    broken by the degree heuristic, preferring the variable with the most neighbors.
+    Both are combined into one key, and min() picks the best key among the unassigned
+    variables. If more than one variable has that key, meaning both the minimum
+    remaining value and the degree heuristics could not choose a variable, a random
+    variable is chosen and returned.
+    """
+    unassigned = [v for v in csp.variables if not csp.assigned_mask >> v & 1]
+    if csp.current_domains:
+        key = lambda v: (csp.current_domains[v].bit_count(), -csp.degree[v])
     else:
-        current_max = 0
-        temp_max = 0
-        max_neighbors = []
-        for region in minimum_remaining_values_list:
-            if len(csp.neighbors_dictionary[region]) == current_max:
-                max_neighbors.append(region)
-            elif len(csp.neighbors_dictionary[region]) > current_max:
-                max_neighbors = [region]
-                current_max = len(csp.neighbors_dictionary[region])
-        return random.choice(max_neighbors)
-    
+        key = lambda v: (-csp.assigned_neighbor_count[v], -csp.degree[v])
+    keys = [key(v) for v in unassigned]
+    best_key = min(keys)
+    best_variables = [v for v, k in zip(unassigned, keys) if k == best_key]
+
+    if len(best_variables) == 1:
+        return best_variables[0]
+    return random.choice(best_variables)
+
 """
-The function below returns each domain value one by one in the same order written in
-the input file. If forward-checking is set to true, it returns each domain value one 
-by one from the current variable's domain.
+The function below returns the list of domain value indices to try for the passed in
+variable, in the same order written in the input file. If forward-checking is set to
+true, the values are the set bits of the current variable's domain, taking off the
+lowest set bit on every step, and they are ordered using the least-constraining-value
+heuristic instead. Each value gets a score equal to the number of unassigned neighbors
+that still have it in their domain, and the values are returned from the lowest score
+to the highest, in file order when the scores are equal.
 """
 def order_domain_values(variable, csp):
-    if csp.current_domains:
-        domain = csp.current_domains[variable]
-    else:
-        domain = csp.domain_values[variable][:]
+    if not csp.current_domains:
+        return csp.domain_values[variable]
 
-    while domain:
-        yield domain.pop()
+    mask = csp.current_domains[variable]
+    values = []
+    while mask:
+        lowest_bit = mask & -mask
+        mask ^= lowest_bit
+        values.append(lowest_bit.bit_length() - 1)
+
+    neighbor_domains = [csp.current_domains[n] for n in csp.neighbors_dictionary[variable]
+                        if not csp.assigned_mask >> n & 1]
+    scores = [(sum((domain >> value) & 1 for domain in neighbor_domains), value)
+              for value in values]
+    return [value for (score, value) in sorted(scores)]
+
+"""
+The function below returns the list of domain value indices from order_domain_values
+that have no conflicts with the passed in variable's assigned neighbors. It is used
+when forward-checking is not set to true.
+"""
+def consistent_domain_values(variable, csp):
+    return [value for value in order_domain_values(variable, csp)
+            if csp.number_of_conflicts(variable, value) == 0]
 
 """
-The function below reads the input file and returns a CSP object from the class above.
+The function below reads the input file and returns the names of the variables, the
+names of the colors, and a CSP object from the class above. Inside the CSP object,
+every color is referred to by its index in the list of color names.
 """
 def read_file(filename):
     file = open(filename,'r')
@@ -201,54 +424,65 @@ def read_file(filename):
     temp = file.readline()
     temp = temp.strip()
     domain_values = temp.split(' ')
-    constraints_array = []
-
-    for i in range(number_of_regions):
-        temp = []
-        temp = file.readline()
-        temp = temp.strip()
-        temp = temp.split(' ')
-        for j in range(number_of_regions):
-            temp[j] = int(temp[j])
-        constraints_array.append(temp)
-    
-    domain_values.reverse()
+
+    """
+    The rest of the file is the constraints array. It is read and split in one go, all
+    the values are converted to integers with a single map, and the flat list is then
+    cut into one row per region.
+    """
+    temp = list(map(int, file.read().split()))
+    constraints_array = [temp[i * number_of_regions:(i + 1) * number_of_regions]
+                         for i in range(number_of_regions)]
 
     """
     This section below uses the constraints array given in the input file to create
-    a dictionary containing the neighbors of each variable. 
+    a dictionary containing the neighbors of each variable. Inside the CSP object,
+    every variable is referred to by its index in the variables list. Each pair of
+    variables is only visited once, and the neighbors are collected in sets so that
+    duplicates are dropped. They are then stored as sorted tuples.
     """
-    neighbors_dictionary = {name:[] for name in variables}
-    for i in range(number_of_regions):
-        for j in range(number_of_regions):
-            if constraints_array[i][j] == 1:
-                if variables[j] not in neighbors_dictionary[variables[i]]:
-                    neighbors_dictionary[variables[i]].append(variables[j])
-                if variables[i] not in neighbors_dictionary[variables[j]]:
-                    neighbors_dictionary[variables[j]].append(variables[i])
+    indices = range(number_of_regions)
+    neighbor_sets = {i:set() for i in indices}
+    for i in indices:
+        for j in range(i + 1, number_of_regions):
+            if constraints_array[i][j] == 1 or constraints_array[j][i] == 1:
+                neighbor_sets[i].add(j)
+                neighbor_sets[j].add(i)
+    neighbors_dictionary = {i:tuple(sorted(neighbor_sets[i])) for i in indices}
 
-    return variables, CSP(neighbors_dictionary.keys(), {name:domain_values for name in variables}, neighbors_dictionary)
+    color_indices = range(len(domain_values))
+    return variables, domain_values, CSP(list(indices), {i:color_indices for i in indices}, neighbors_dictionary)
 
 """
 The function below writes the result returned from the backtracking algorithm to the
-output file.
+output file. The result holds the color of each variable at the variable's index in the
+variables list, and the color indices are turned back into the color names here.
 """
-def write_file(variables, result, filename):
+def write_file(variables, domain_values, result, filename):
     file = open(filename,'w')
-    for name in variables:
+    for (i, name) in enumerate(variables):
         if variables[-1] != name:
-            file.write(name + ' = ' + result[name] + '\n')
+            file.write(name + ' = ' + domain_values[result[i]] + '\n')
         else:
-            file.write(name + ' = ' + result[name])
+            file.write(name + ' = ' + domain_values[result[i]])
 
 """
 The function below is the main function that takes in an input file, an output file,
-and an optional third argument for a boolean stating whether forward checking is
-enabled or not.
+an optional third argument for a boolean stating whether forward checking is
+enabled or not, an optional fourth argument for the number of processes that the
+search is split between, and an optional fifth argument for a boolean stating whether
+nogood recording is enabled or not.
 """
-def main(input, output, is_forward_checking = False):
-    variables, map = read_file(input)
-    result = backtracking_algorithm(map, is_forward_checking)
-    write_file(variables, result, output)
+def main(input, output, is_forward_checking = False, number_of_processes = 1,
+         is_recording_nogoods = False):
+    variables, domain_values, map = read_file(input)
+    result = backtracking_algorithm(map, is_forward_checking, number_of_processes,
+                                    is_recording_nogoods)
+    write_file(variables, domain_values, result, output)
 
-main("Input1.txt", "test_output.txt", True)
\ No newline at end of file
+"""
+The call below is guarded so that the worker processes started by the parallel search
+do not run it again when they import this file.
+"""
+if __name__ == "__main__":
+    main("Input1.txt", "test_output.txt", True)
\ No newline at end of file